@@ -1,16 +1,45 @@
 import argparse
-import base64
+import html
+import io
+import json
+import mmap
 import os
 import re
+import sys
 from pathlib import Path
 from typing import List, Tuple
 
+from mutagen import MutagenError
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, ID3NoHeaderError
+from mutagen.id3 import TIT2, COMM, TLAN, TDES, TT2, COM, TLA
 
-# Subtitle entry: (start_seconds, end_seconds, text)
+try:
+    # SIMD-accelerated drop-in replacement for the standard base64 module.
+    import pybase64
+except ImportError:
+    import base64 as pybase64
+
+# Subtitle entry: (start_seconds, end_seconds, html_escaped_text)
 SubtitleEntry = Tuple[float, float, str]
 
+# SRT styling tags as they look after html.escape: <i>, <b>, <u> are kept, <font ...> is dropped.
+SRT_STYLE_TAG_RE = re.compile(r"&lt;(/?)([ibu])&gt;", re.IGNORECASE)
+SRT_FONT_TAG_RE = re.compile(r"&lt;/?font\b.*?&gt;", re.IGNORECASE)
+
+# ID3 frames used for the page title and metadata; all other frames (e.g. cover art) are left undecoded.
+# known_frames replaces mutagen's whole frame table, so the ID3v2.2 ids must be listed too;
+# mutagen then upgrades them to their v2.4 equivalents.
+ID3_FRAMES = {"TIT2": TIT2, "COMM": COMM, "TLAN": TLAN, "TDES": TDES, "TT2": TT2, "COM": COM, "TLA": TLA}
+
+# Bytes read per base64 step; a multiple of 3 so no padding appears mid-stream.
+B64_CHUNK_SIZE = 3 * 64 * 1024
+
+# Embedded MP3s above this size make the page slow to open; main suggests --no-embed-mp3.
+EMBED_WARN_SIZE = 20_000_000
+
+# Write buffer for the output HTML, which can be hundreds of MB with an embedded MP3.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
 
 def parse_args():
     """Parses command-line arguments."""
@@ -26,56 +55,97 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_audio_duration(path: str) -> float:
-    """Gets the duration of an MP3 file in seconds."""
-    audio = MP3(path)
-    return audio.info.length
-
-
-def parse_srt_timecode(time_str: str) -> float:
-    """Converts SRT timecode string to seconds."""
-    h, m, s_ms = time_str.split(":")
-    s, ms = s_ms.replace(",", ".").split(".")
-    return int(h) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000.0
+def parse_srt_timecode(time_str: str, pos: int = 0) -> float:
+    """Converts the SRT timecode (HH:MM:SS,mmm) at position pos of a string to seconds."""
+    try:
+        return (int(time_str[pos:pos + 2]) * 3600 + int(time_str[pos + 3:pos + 5]) * 60
+                + int(time_str[pos + 6:pos + 8]) + int(time_str[pos + 9:pos + 12]) / 1000.0)
+    except ValueError:
+        # Not zero-padded (e.g. "0:00:05,000"): split on the separators instead.
+        *h, m, s_ms = time_str[pos:].split(" ", 1)[0].split(":")
+        s, ms = s_ms.replace(",", ".").split(".")
+        return (int(h[0]) if h else 0) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000.0
+
+
+def escape_subtitle_text(text: str) -> str:
+    """HTML-escapes subtitle text, keeping the standard SRT <i>, <b> and <u> styling tags."""
+    text = html.escape(text, quote=False)
+    if "&lt;" not in text:
+        return text
+    text = SRT_FONT_TAG_RE.sub("", text)
+
+    # Restore only tags whose open/close pair is complete within the cue, so an
+    # unclosed <i> or a stray </b> cannot leak into the following segments.
+    tags = list(SRT_STYLE_TAG_RE.finditer(text))
+    open_tags = []  # (tag name, index in tags) of currently unmatched opening tags
+    paired = []
+    for i, match in enumerate(tags):
+        name = match.group(2).lower()
+        if not match.group(1):
+            open_tags.append((name, i))
+        elif open_tags and open_tags[-1][0] == name:
+            paired += (open_tags.pop()[1], i)
+    if not paired:
+        return text
+
+    parts = []
+    pos = 0
+    for i in sorted(paired):
+        match = tags[i]
+        parts.append(text[pos:match.start()])
+        parts.append(f"<{match.group(1)}{match.group(2)}>")
+        pos = match.end()
+    parts.append(text[pos:])
+    return "".join(parts)
 
 
 def parse_srt(path: str, audio_length: float) -> List[SubtitleEntry]:
     """Parses an SRT file and returns a list of subtitle entries."""
-    with open(path, encoding="utf-8") as f:
-        content = f.read()
-
-    pattern = re.compile(r"(\d+)\s+([\d:,]+) --> ([\d:,]+)\s+(.*?)\s+(?=\d+\s+[\d:,]+ -->|\Z)", re.DOTALL)
-    entries = []
-    for match in pattern.finditer(content):
-        start = parse_srt_timecode(match.group(2))
-        end = parse_srt_timecode(match.group(3))
-        text = " ".join(line.strip() for line in match.group(4).splitlines())
-        if not (0 <= start < end <= audio_length):
-            continue
-        entries.append((start, end, text))
-
-    return entries
-
-
-def audio_to_base64(path: str) -> str:
-    """Encodes an audio file to a base64 data URI."""
-    with open(path, "rb") as f:
-        encoded = base64.b64encode(f.read()).decode("utf-8")
-    return f"data:audio/mpeg;base64,{encoded}"
-
-
-def format_timestamp(seconds: float) -> str:
-    """Formats seconds into a MM:SS string."""
-    mins = int(seconds // 60)
-    secs = int(seconds % 60)
-    return f"{mins:02}:{secs:02}"
-
-
-def render_html(audio_data_uri: str, subtitles: List[SubtitleEntry], title: str, metadata_str: str) -> str:
-    """Renders the final HTML page with all data."""
-    metadata_html = f'<p class="metadata">{metadata_str}</p>' if metadata_str else ''
-
-    html = f"""
+    cues = []
+    text_lines = None  # Text of the cue being read, or None between cues.
+    # Read the whole file at once; read_text also normalizes \r\n line endings.
+    for line in Path(path).read_text(encoding="utf-8").split("\n"):
+        line = line.strip()
+        if not line:
+            # Blank (or whitespace-only) lines end the current cue.
+            text_lines = None
+        elif text_lines is not None:
+            text_lines.append(line)
+        else:
+            # Outside a cue only the timecode line matters; the index line is skipped.
+            sep = line.find(" --> ")
+            if sep != -1:
+                try:
+                    start, end = parse_srt_timecode(line), parse_srt_timecode(line, sep + 5)
+                except ValueError:
+                    continue  # Malformed timecode: skip this cue, like out-of-range ones.
+                text_lines = []
+                cues.append((start, end, text_lines))
+
+    return [(start, end, escape_subtitle_text(" ".join(lines)))
+            for start, end, lines in cues if 0 <= start < end <= audio_length]
+
+
+def iter_audio_base64(path: str):
+    """Yields the base64 encoding of an audio file as ASCII byte chunks, reading it through mmap."""
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, size, B64_CHUNK_SIZE):
+                yield pybase64.b64encode(view[offset:offset + B64_CHUNK_SIZE])
+
+
+def render_html_head(title: str, metadata_str: str, audio_src_prefix: str = "data:audio/mpeg;base64,") -> str:
+    """Renders the HTML page up to and including the start of the audio source URL."""
+    title = html.escape(title, quote=False)
+    metadata_html = f'<p class="metadata">{html.escape(metadata_str, quote=False)}</p>' if metadata_str else ''
+    audio_src_prefix = html.escape(audio_src_prefix)
+
+    return f"""
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -125,21 +195,30 @@ def render_html(audio_data_uri: str, subtitles: List[SubtitleEntry], title: str,
   <h2>{title}</h2>
   {metadata_html}
   <div class="player-row">
-    <audio id="player" controls preload="auto">
-      <source src="{audio_data_uri}" type="audio/mpeg">
+    <audio id="player" controls preload="metadata">
+      <source src="{audio_src_prefix}"""
+
+
+def render_html_tail(subtitles: List[SubtitleEntry]) -> str:
+    """Renders the rest of the HTML page after the audio source URL."""
+    # Segments are written straight into the buffer instead of being collected and joined.
+    sio = io.StringIO()
+    sio.write("""" type="audio/mpeg">
       Your browser does not support the audio element.
     </audio>
     <button class="jump-button" onclick="scrollToCurrentSegment()">To text</button>
   </div>
   <div id="transcript">
-"""
+""")
+    starts = []  # Segment i has the element id "seg{i}".
     for i, (start, _, text) in enumerate(subtitles):
-        html += f'<p id="seg{i}" class="transcript-segment"><a class="timestamp" onclick="seekTo({start:.2f})">[{format_timestamp(start)}]</a> {text}</p>\n'
+        mins, secs = divmod(int(start), 60)  # MM:SS timestamp
+        sio.write(f'<p id="seg{i}" class="transcript-segment"><a class="timestamp" onclick="seekTo({start:.2f})">[{mins:02}:{secs:02}]</a> {text}</p>\n')
+        starts.append(round(start, 2))
+    # A JSON string literal is parsed faster by browsers than an equivalent JS array literal.
+    starts_json = json.dumps(starts, separators=(",", ":"))
 
-    segment_array = [f"{{start: {start:.2f}, id: 'seg{i}'}}" for i, (start, _, _) in enumerate(subtitles)]
-    segments_js = ",\n      ".join(segment_array)
-
-    html += f"""
+    sio.write(f"""
   </div>
   <div id="scrollTopBtn">
     <button onclick="scrollToTop()">↑ To audio</button>
@@ -148,9 +227,8 @@ def render_html(audio_data_uri: str, subtitles: List[SubtitleEntry], title: str,
   <script>
     const player = document.getElementById("player");
     const playPauseBtn = document.getElementById("playPauseBtn");
-    const segments = [
-      {segments_js}
-    ];
+    const btnContainer = document.getElementById("scrollTopBtn");
+    const starts = new Float64Array(JSON.parse('{starts_json}'));
 
     function togglePlay() {{
       if (player.paused) {{
@@ -170,23 +248,23 @@ def render_html(audio_data_uri: str, subtitles: List[SubtitleEntry], title: str,
     }});
 
     function seekTo(seconds) {{
-      const player = document.getElementById("player");
       player.currentTime = seconds;
       player.play();
     }}
 
     function scrollToCurrentSegment() {{
-      const player = document.getElementById("player");
       const current = player.currentTime;
-      let closest = segments[0];
-      for (const s of segments) {{
-        if (s.start <= current) {{
-          closest = s;
+      // Binary search for the last segment starting at or before the current time.
+      let lo = 0, hi = starts.length;
+      while (lo < hi) {{
+        const mid = (lo + hi) >> 1;
+        if (starts[mid] <= current) {{
+          lo = mid + 1;
         }} else {{
-          break;
+          hi = mid;
         }}
       }}
-      const el = document.getElementById(closest.id);
+      const el = document.getElementById("seg" + Math.max(lo - 1, 0));
       if (el) {{
         el.scrollIntoView({{ behavior: "smooth" }});
         el.classList.add("highlight");
@@ -198,19 +276,27 @@ def render_html(audio_data_uri: str, subtitles: List[SubtitleEntry], title: str,
       window.scrollTo({{top: 0, behavior: 'smooth'}});
     }}
 
+    // Update the floating buttons at most once per animation frame.
+    let scrollTicking = false;
     window.addEventListener('scroll', () => {{
-      const btnContainer = document.getElementById("scrollTopBtn");
-      if (window.scrollY > 300) {{
-        btnContainer.style.display = "flex";
-      }} else {{
-        btnContainer.style.display = "none";
+      if (scrollTicking) {{
+        return;
       }}
+      scrollTicking = true;
+      requestAnimationFrame(() => {{
+        if (window.scrollY > 300) {{
+          btnContainer.style.display = "flex";
+        }} else {{
+          btnContainer.style.display = "none";
+        }}
+        scrollTicking = false;
+      }});
     }});
   </script>
 </body>
 </html>
-"""
-    return html
+""")
+    return sio.getvalue()
 
 
 def main():
@@ -223,45 +309,68 @@ def main():
     else:
         output_path = Path(args.output)
 
-    assert os.path.exists(args.audio), f"Audio file not found: {args.audio}"
-    assert os.path.exists(args.subtitles), f"Subtitle file not found: {args.subtitles}"
-
-    audio_length = get_audio_duration(args.audio)
-    subtitles = parse_srt(args.subtitles, audio_length)
+    # Один проход по файлу: длительность и теги читаются вместе.
+    # Длительность mutagen берёт из заголовка Xing/VBRI первого кадра, а без него
+    # оценивает по размеру файла, так что весь MP3 не сканируется.
+    try:
+        mp3 = MP3(args.audio, known_frames=ID3_FRAMES)
+    except MutagenError as e:
+        # mutagen оборачивает ошибки ввода-вывода в MutagenError
+        if e.args and isinstance(e.args[0], FileNotFoundError):
+            sys.exit(f"Audio file not found: {args.audio}")
+        raise
+    audio_length = mp3.info.length
+    try:
+        subtitles = parse_srt(args.subtitles, audio_length)
+    except FileNotFoundError:
+        sys.exit(f"Subtitle file not found: {args.subtitles}")
     assert subtitles, "No valid subtitle entries found."
 
-    title = os.path.basename(args.audio)
+    audio_name = Path(args.audio).name
+    title = audio_name
     metadata_parts = []
-    try:
-        audio_tags = ID3(args.audio)
-        if 'TIT2' in audio_tags:
-            title = str(audio_tags.get('TIT2').text[0])
-        if 'COMM' in audio_tags:
-            comment_text = audio_tags.getall('COMM')[0].text[0]
-            metadata_parts.append(f"Comment: {comment_text}")
-        if 'TLAN' in audio_tags:
-            lang_text = str(audio_tags.get('TLAN').text[0])
-            metadata_parts.append(f"Language: {lang_text}")
-        if 'TDES' in audio_tags:
-            podcast_info_text = str(audio_tags.get('TDES').text[0])
-            metadata_parts.append(f"Podcast info: {podcast_info_text}")
-
-    except ID3NoHeaderError:
+    audio_tags = mp3.tags
+    if audio_tags is None:
         print("Info: No ID3 tags found in the audio file.")
-    except Exception as e:
-        print(f"Warning: Could not read ID3 tags. Error: {e}")
+    else:
+        try:
+            # Первый кадр каждого типа за один проход; ключи COMM имеют вид "COMM:desc:lang"
+            frames = {}
+            for frame in audio_tags.values():
+                frames.setdefault(frame.FrameID, frame)
+            if 'TIT2' in frames:
+                title = str(frames['TIT2'].text[0])
+            if 'COMM' in frames:
+                comment_text = frames['COMM'].text[0]
+                metadata_parts.append(f"Comment: {comment_text}")
+            if 'TLAN' in frames:
+                lang_text = str(frames['TLAN'].text[0])
+                metadata_parts.append(f"Language: {lang_text}")
+            if 'TDES' in frames:
+                podcast_info_text = str(frames['TDES'].text[0])
+                metadata_parts.append(f"Podcast info: {podcast_info_text}")
+        except Exception as e:
+            print(f"Warning: Could not read ID3 tags. Error: {e}")
 
     metadata_str = ", ".join(metadata_parts)
 
-    if args.no_embed_mp3:
-        audio_data_uri = os.path.basename(args.audio)
-    else:
-        audio_data_uri = audio_to_base64(args.audio)
-
-    html = render_html(audio_data_uri, subtitles, title, metadata_str)
-    
-    # Используем определённый ранее путь для сохранения файла
-    output_path.write_text(html, encoding="utf-8")
+    if not args.no_embed_mp3:
+        audio_size = os.path.getsize(args.audio)
+        if audio_size > EMBED_WARN_SIZE:
+            print(f"Warning: Embedding a {audio_size / 1_000_000:.0f} MB audio file; "
+                  "the page may be slow to open. Consider --no-embed-mp3.")
+
+    # Используем определённый ранее путь для сохранения файла.
+    # Аудио записывается по частям, чтобы не держать всю страницу в памяти.
+    # Файл пишется в бинарном режиме: base64 уже ASCII и не проходит через TextIOWrapper.
+    with output_path.open("wb", buffering=OUTPUT_BUFFER_SIZE) as out:
+        if args.no_embed_mp3:
+            out.write(render_html_head(title, metadata_str, audio_name).encode("utf-8"))
+        else:
+            out.write(render_html_head(title, metadata_str).encode("utf-8"))
+            for chunk in iter_audio_base64(args.audio):
+                out.write(chunk)
+        out.write(render_html_tail(subtitles).encode("utf-8"))
     print(f"HTML file successfully written to {output_path}")
 
 